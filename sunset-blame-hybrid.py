@@ -11,7 +11,7 @@ FIXME: citation needed.
 Overview:
  1. list all regular files in commit (git ls-tree -z -r --name-only).
  2. skip any binary files (e.g. foo.jpg, bar.zip).
- 3. for anything that's left, find the age of each line (git blame -w -M -C).
+ 3. for anything that's left, find the age of each line (git blame, plus -w -M with --accurate, and -C with --detect-copies).
  4. report the mean & modal age for that file.
 
 UPDATE Mar 2019 --- ported from fork+exec git(1) to dlopen of libgit2.
@@ -33,18 +33,47 @@ UPDATE Mar 2021 --- use pygit2 for everything *except* blame.
 """
 
 import argparse
+import array
 import collections
 import csv
 import datetime
+import functools
 import logging
+import multiprocessing
+import operator
 import os
-import re
-import statistics
 import subprocess
 import sys
 
 import pygit2
 
+try:
+    import numpy                # optional, only used to go faster on huge files
+except ImportError:
+    numpy = None
+
+# Unix epoch (1970-01-01) as a date ordinal, i.e. 719163.
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# Vendored/generated code is often most of the tree, but tells us nothing
+# about which parts of *our* code are stale.
+EXCLUDE_DIRS = frozenset({
+    'node_modules', 'vendor', 'third_party',
+    'dist', 'build', 'target', 'docs/_build',
+    '.venv', '.tox', '__pycache__'})
+
+# Files that are obviously binary, going by the name alone.
+BINARY_SUFFIXES = frozenset({
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.ico',
+    '.zip', '.gz', '.xz', '.bz2', '.tar', '.7z', '.jar',
+    '.pdf', '.mp3', '.mp4', '.mov', '.ogg',
+    '.woff', '.woff2', '.ttf', '.otf', '.eot',
+    '.so', '.a', '.o', '.dll', '.dylib', '.exe', '.wasm',
+    '.pyc', '.class'})
+
+# Below this many hunks, a Counter is faster than numpy.
+NUMPY_MIN_HUNKS = 256
+
 
 def main() -> None:
     parser = argparse.ArgumentParser()
@@ -53,88 +82,213 @@ def main() -> None:
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--verbose', action='store_true')
     parser.add_argument('--csv', action='store_true', help='default is TSV')
+    parser.add_argument(
+        '--exclude-dir', action='append', metavar='DIR',
+        help='skip directories with this name (e.g. vendor) or path (e.g. docs/_build).'
+        ' Can be given more than once.'
+        ' Replaces the default list: %(default_dirs)s.'
+        ' Use --exclude-dir= to skip nothing.' % {
+            'default_dirs': ' '.join(sorted(EXCLUDE_DIRS))})
+    parser.add_argument(
+        '--accurate', action='store_true',
+        help='use "git blame -w -M", i.e. ignore whitespace changes,'
+        ' and follow lines moved within a file.'
+        ' This is slower, and'
+        ' usually makes little difference to how stale a file looks.')
+    parser.add_argument(
+        '--detect-copies', action='store_true',
+        help='also use "git blame -C", i.e. follow lines moved or copied between files.'
+        ' This is MUCH slower (especially on big, old repos with lots of refactoring).')
     # FIXME: add support for sunset-blaming specific subdirs, e.g. src/ but not doc/.
     args = parser.parse_args()
+    args.exclude_dir = frozenset(
+        EXCLUDE_DIRS if args.exclude_dir is None else
+        (d.strip('/') for d in args.exclude_dir))
     logging.getLogger().setLevel(
         logging.DEBUG if args.debug else
         logging.INFO if args.verbose else
         logging.WARNING)
+    # NOTE: -C is by far the most expensive, because it has to look at other files too.
+    blame_options = (
+        (['-w', '-M'] if args.accurate else []) +
+        (['-C'] if args.detect_copies else []))
 
     repo = pygit2.Repository(args.git_dir)
     commit = repo.revparse_single(args.revision)
     tree = commit.tree
 
-    writer = csv.writer(sys.stdout,
-                        dialect=csv.excel if args.csv else csv.excel_tab)
-    writer.writerow((
-        'DATE(MEAN)',
-        'DATE(MODE)',
-        'WHO(MODE)',
-        'PATH'))
     os.environ['GIT_DIR'] = args.git_dir  # subprocess git-blame needs this
     os.environ['GIT_WORKTREE'] = '/nonexistent'  # safety net
-    walk(args, writer, repo, commit, tree)
+    # Rows are written by the parent only, and there are a lot of them,
+    # so write them to stdout in 1MiB chunks, not the default 8KiB (or a line at a time on a tty).
+    with open(sys.stdout.fileno(), 'w',
+              buffering=1 << 20,
+              encoding=sys.stdout.encoding,
+              errors=sys.stdout.errors,
+              newline='',
+              closefd=False) as stdout:
+        writer = csv.writer(stdout,
+                            dialect=csv.excel if args.csv else csv.excel_tab)
+        writer.writerow((
+            'DATE(MEAN)',
+            'DATE(MODE)',
+            'WHO(MODE)',
+            'PATH'))
+        # Each git-blame is independent, so run several at once.
+        # Worker processes (not threads) so parsing the blame output isn't serialized on the GIL.
+        # Only the parent touches pygit2 objects (they're not thread-safe) or writes output.
+        # pool.imap() keeps the output in tree order;
+        # chunksize batches the paths, because files in one directory tend to come together.
+        # Cap the number of workers, so we don't run out of file descriptors or RAM.
+        cpus = usable_cpus()[:8]
+        cpu_queue = multiprocessing.SimpleQueue()
+        for cpu in cpus:
+            cpu_queue.put(cpu)
+        with multiprocessing.Pool(
+                len(cpus),
+                initializer=init_worker,
+                initargs=(logging.getLogger().level, cpu_queue)) as pool:
+            # filter(None, ...) drops empty files, which blame() returns as None.
+            writer.writerows(filter(None, pool.imap(
+                functools.partial(blame, str(commit.id), blame_options),
+                walk(args, repo, tree),
+                chunksize=16)))
+
+
+def usable_cpus() -> list:
+    # NOTE: os.cpu_count() also counts CPUs we aren't allowed to run on
+    #       (taskset, or a cgroup cpuset in a container/CI runner),
+    #       so a pool that size oversubscribes the ones we do have.
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:      # not Linux
+        return list(range(os.cpu_count()))
+
+
+def init_worker(log_level, cpu_queue) -> None:
+    # NOTE: with the spawn/forkserver start methods (macOS, Python 3.14+ on Linux),
+    #       workers don't inherit main()'s log level, so --verbose/--debug would be lost.
+    logging.getLogger().setLevel(log_level)
+    pin_to_cpu(cpu_queue)
 
 
-def walk(args, writer, repo, commit, tree, parent_dirs='') -> None:
-    for entry in tree:
-        entry_path = os.path.join(parent_dirs, entry.name)
+def pin_to_cpu(cpu_queue) -> None:
+    # Pin each worker (and so the git processes it starts) to its own CPU,
+    # so they don't keep migrating between cores and thrashing each other's caches.
+    # Put the CPU back at the end of the queue, so it's round-robin
+    # (rather than hanging) if the pool ever starts more workers than there are CPUs.
+    cpu = cpu_queue.get()
+    cpu_queue.put(cpu)
+    if hasattr(os, 'sched_setaffinity'):  # not Linux
+        os.sched_setaffinity(0, {cpu})
+
+
+def walk(args, repo, tree):
+    # Walk the tree with an explicit stack of iterators, instead of recursing.
+    # This keeps the same (depth-first) order, but skips os.path.join(), and
+    # uses the Tree/Blob objects that iterating a tree already gives us,
+    # instead of looking each one up again with git_object_lookup_prefix().
+    stack = [('', iter(tree))]
+    while stack:
+        parent_dirs, entries = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            stack.pop()
+            continue
+        entry_path = parent_dirs + entry.name
         logging.debug('entry_path is %s', entry_path)
         if entry.type == pygit2.GIT_OBJ_TREE:
-            walk(args, writer,          # global
-                 repo,          # global
-                 commit,        # global
-                 repo.git_object_lookup_prefix(entry.id),  # turn TreeEntry into Tree
-                 entry_path)                               # prefix for path names
+            if entry.name in args.exclude_dir or entry_path in args.exclude_dir:
+                logging.info('skipping %s', entry_path)
+            else:
+                stack.append((entry_path + '/', iter(entry)))
         elif entry.type == pygit2.GIT_OBJ_COMMIT:
             logging.info('Ignoring submodule %s', entry_path)
         elif entry.type == pygit2.GIT_OBJ_BLOB:
-            blob = repo.git_object_lookup_prefix(entry.id)
-            if blob.is_binary:
+            # Check the name first, because is_binary has to load (and inflate) the blob.
+            if os.path.splitext(entry.name)[1].lower() in BINARY_SUFFIXES or entry.is_binary:
                 logging.info('ignoring binary blob %s', entry_path)
             else:
-                # FIXME: use pygit2 when this is fixed:
-                #          https://github.com/libgit2/libgit2/issues/3027
-                with subprocess.Popen(
-                        ['git', 'blame', '--incremental', '-wMC', str(commit.id), '--', entry_path],
-                        text=True,
-                        stdout=subprocess.PIPE) as p:
-                    authors, dates = collections.Counter(), collections.Counter()
-                    # FIXME: WHY THE FUCK DOESN'T CPYTHON SHIP *ANY* LL(k) OR LALR PARSER?
-                    for line in p.stdout:
-                        line = line.strip()
-                        if re.match(r'[0-9a-f]{40} ', line):
-                            if (m := re.fullmatch(r'[0-9a-f]{40} \d+ \d+ (\d+)', line)):
-                                lines_in_hunk = int(m.group(1))
-                        elif (m := re.fullmatch(r'author (.+)', line)):
-                            author = m.group(1)
-                        # elif (m := re.fullmatch(r'author-mail (.+)', line)):
-                        #     author += f' {m.group(1)}'
-                        elif (m := re.fullmatch(r'author-time (.+)', line)):
-                            date = datetime.datetime.utcfromtimestamp(int(m.group(1))).toordinal()
-                        elif line.startswith('filename '):
-                            # End of record, add it to the counters.
-                            authors[author] += lines_in_hunk
-                            dates[date] += lines_in_hunk
-                    p.wait()
-                    if p.returncode != 0:
-                        raise subprocess.CalledProcessError(p.returncode, p.cmd)
-                if sum(dates.values()) == 0:
-                    logging.info('ignoring empty file %s', entry_path)
-                    continue
-                author_mode = authors.most_common(1)[0][0]
-                date_mode = datetime.date.fromordinal(dates.most_common(1)[0][0])
-                date_mean = datetime.date.fromordinal(int(statistics.mean(dates.elements())))
-                # FIXME: collate mean(time) and mode(time), print nicer line.
-                writer.writerow((
-                    date_mean,
-                    date_mode,
-                    author_mode,
-                    entry_path))
-
+                yield entry_path
         else:
             raise Exception('Unknown TreeEntry type', entry, entry.type)
 
 
+def blame(commit_id, blame_options, entry_path):
+    # FIXME: use pygit2 when this is fixed:
+    #          https://github.com/libgit2/libgit2/issues/3027
+    # NOTE: the output is bytes, because it is a mix of different
+    # encodings (depending on the input data).
+    # The author-* lines only appear the first time a commit shows up,
+    # so remember them per commit.
+    with subprocess.Popen(
+            ['git', 'blame', '--incremental', *blame_options, commit_id, '--', entry_path],
+            stdout=subprocess.PIPE) as p:
+        authors = collections.Counter()
+        # Typed arrays (8 bytes/hunk), not lists of int objects (~36 bytes/hunk),
+        # and numpy can use them in place, see date_mode_and_mean().
+        hunk_dates, hunk_lines = array.array('q'), array.array('q')
+        commits = {}
+        record = None
+        for line in p.stdout:
+            if record is None:
+                # "<sha> <orig-line> <final-line> <lines-in-hunk>"
+                parts = line.split(b' ')
+                lines_in_hunk = int(parts[3])
+                record = commits.setdefault(parts[0], {})
+            elif line.startswith(b'author '):
+                record['author'] = line[7:-1]
+            # elif line.startswith(b'author-mail '):
+            #     record['author'] += b' ' + line[12:-1]
+            elif line.startswith(b'author-time '):
+                # NOTE: UTC days since the epoch, same as utcfromtimestamp(i).toordinal().
+                record['date'] = int(line[12:]) // 86400 + EPOCH_ORDINAL
+            elif line.startswith(b'filename '):
+                # End of record, add it to the counters.
+                authors[record['author']] += lines_in_hunk
+                hunk_dates.append(record['date'])
+                hunk_lines.append(lines_in_hunk)
+                record = None
+        p.wait()
+        if p.returncode != 0:
+            raise subprocess.CalledProcessError(p.returncode, p.args)
+    if sum(hunk_lines) == 0:
+        logging.info('ignoring empty file %s', entry_path)
+        return None
+    author_mode = max(authors.items(), key=operator.itemgetter(1))[0].decode('utf8', 'replace')
+    date_mode, date_mean = date_mode_and_mean(hunk_dates, hunk_lines)
+    # FIXME: collate mean(time) and mode(time), print nicer line.
+    return (
+        datetime.date.fromordinal(date_mean),
+        datetime.date.fromordinal(date_mode),
+        author_mode,
+        entry_path)
+
+
+def date_mode_and_mean(hunk_dates, hunk_lines):
+    # Dates are ordinals in a narrow range, so for big files, let numpy
+    # count them in C instead of bumping a Counter one hunk at a time.
+    # For small files, building the numpy arrays costs more than it saves.
+    if numpy is not None and len(hunk_dates) >= NUMPY_MIN_HUNKS:
+        # NOTE: frombuffer() wraps the array.array('q') buffers, no copying.
+        dates = numpy.frombuffer(hunk_dates, dtype=numpy.int64)
+        lines = numpy.frombuffer(hunk_lines, dtype=numpy.int64)
+        date_min = dates.min()
+        histogram = numpy.bincount(dates - date_min, weights=lines)
+        return (
+            int(histogram.argmax() + date_min),
+            int((dates * lines).sum() // lines.sum()))
+    dates = collections.Counter()
+    for date, lines_in_hunk in zip(hunk_dates, hunk_lines):
+        dates[date] += lines_in_hunk
+    return (
+        # On a tie, take the earliest date, same as argmax() does above,
+        # so the answer doesn't depend on whether numpy is installed.
+        max(dates.items(), key=lambda item: (item[1], -item[0]))[0],
+        # Weighted mean straight off the histogram, instead of expanding it
+        # one element per line with dates.elements().
+        sum(date * count for date, count in dates.items()) // sum(dates.values()))
+
+
 if __name__ == '__main__':
     main()
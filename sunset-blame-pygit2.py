@@ -30,14 +30,32 @@ import argparse
 import collections
 import csv
 import datetime
-import functools
 import logging
+import operator
 import os
-import statistics
 import sys
 
 import pygit2
 
+# Unix epoch (1970-01-01) as a date ordinal, i.e. 719163.
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+# Vendored/generated code is often most of the tree, but tells us nothing
+# about which parts of *our* code are stale.
+EXCLUDE_DIRS = frozenset({
+    'node_modules', 'vendor', 'third_party',
+    'dist', 'build', 'target', 'docs/_build',
+    '.venv', '.tox', '__pycache__'})
+
+# Files that are obviously binary, going by the name alone.
+BINARY_SUFFIXES = frozenset({
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.ico',
+    '.zip', '.gz', '.xz', '.bz2', '.tar', '.7z', '.jar',
+    '.pdf', '.mp3', '.mp4', '.mov', '.ogg',
+    '.woff', '.woff2', '.ttf', '.otf', '.eot',
+    '.so', '.a', '.o', '.dll', '.dylib', '.exe', '.wasm',
+    '.pyc', '.class'})
+
 
 def main() -> None:
     parser = argparse.ArgumentParser()
@@ -46,8 +64,18 @@ def main() -> None:
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--verbose', action='store_true')
     parser.add_argument('--csv', action='store_true', help='default is TSV')
+    parser.add_argument(
+        '--exclude-dir', action='append', metavar='DIR',
+        help='skip directories with this name (e.g. vendor) or path (e.g. docs/_build).'
+        ' Can be given more than once.'
+        ' Replaces the default list: %(default_dirs)s.'
+        ' Use --exclude-dir= to skip nothing.' % {
+            'default_dirs': ' '.join(sorted(EXCLUDE_DIRS))})
     # FIXME: add support for sunset-blaming specific subdirs, e.g. src/ but not doc/.
     args = parser.parse_args()
+    args.exclude_dir = frozenset(
+        EXCLUDE_DIRS if args.exclude_dir is None else
+        (d.strip('/') for d in args.exclude_dir))
     logging.getLogger().setLevel(
         logging.DEBUG if args.debug else
         logging.INFO if args.verbose else
@@ -57,87 +85,118 @@ def main() -> None:
     commit = repo.revparse_single(args.revision)
     tree = commit.tree
 
-    writer = csv.writer(sys.stdout,
-                        dialect=csv.excel if args.csv else csv.excel_tab)
-    writer.writerow((
-        'DATE(MEAN)',
-        'DATE(MODE)',
-        'WHO(MODE)',
-        'PATH'))
-    walk(writer, repo, commit, tree)
-
-
-def walk(writer, repo, commit, tree, parent_dirs='') -> None:
-    for entry in tree:
-        entry_path = os.path.join(parent_dirs, entry.name)
+    # There can be a lot of rows,
+    # so write them to stdout in 1MiB chunks, not the default 8KiB (or a line at a time on a tty).
+    with open(sys.stdout.fileno(), 'w',
+              buffering=1 << 20,
+              encoding=sys.stdout.encoding,
+              errors=sys.stdout.errors,
+              newline='',
+              closefd=False) as stdout:
+        writer = csv.writer(stdout,
+                            dialect=csv.excel if args.csv else csv.excel_tab)
+        writer.writerow((
+            'DATE(MEAN)',
+            'DATE(MODE)',
+            'WHO(MODE)',
+            'PATH'))
+        # filter(None, ...) drops empty files, which blame() returns as None.
+        writer.writerows(filter(None, (
+            blame(repo, commit, entry_path)
+            for entry_path in walk(args, repo, tree))))
+
+
+def walk(args, repo, tree):
+    # Walk the tree with an explicit stack of iterators, instead of recursing.
+    # This keeps the same (depth-first) order, but skips os.path.join(), and
+    # uses the Tree/Blob objects that iterating a tree already gives us,
+    # instead of looking each one up again with git_object_lookup_prefix().
+    stack = [('', iter(tree))]
+    while stack:
+        parent_dirs, entries = stack[-1]
+        entry = next(entries, None)
+        if entry is None:
+            stack.pop()
+            continue
+        entry_path = parent_dirs + entry.name
         logging.debug('entry_path is %s', entry_path)
         if entry.type == pygit2.GIT_OBJ_TREE:
-            walk(writer,          # global
-                 repo,          # global
-                 commit,        # global
-                 repo.git_object_lookup_prefix(entry.id),  # turn TreeEntry into Tree
-                 entry_path)                               # prefix for path names
+            if entry.name in args.exclude_dir or entry_path in args.exclude_dir:
+                logging.info('skipping %s', entry_path)
+            else:
+                stack.append((entry_path + '/', iter(entry)))
         elif entry.type == pygit2.GIT_OBJ_COMMIT:
             logging.info('Ignoring submodule %s', entry_path)
         elif entry.type == pygit2.GIT_OBJ_BLOB:
-            blob = repo.git_object_lookup_prefix(entry.id)
-            if blob.is_binary:
+            # Check the name first, because is_binary has to load (and inflate) the blob.
+            if os.path.splitext(entry.name)[1].lower() in BINARY_SUFFIXES or entry.is_binary:
                 logging.info('ignoring binary blob %s', entry_path)
             else:
-                blame = repo.blame(
-                    entry_path,
-                    newest_commit=commit.id,
-                    flags=(
-                        # Ref. https://github.com/libgit2/libgit2/blob/HEAD/include/git2/blame.h#L31
-                        # requires https://github.com/libgit2/libgit2/commit/e3dcaca5
-                        # FIXME: mailmap still ignored as at these Debian 11 in 2021:
-                        #     libgit2-1.1=1.1.0+dfsg.1-4
-                        #     python3-pygit2=1.4.0+dfsg1-1
-                        pygit2.GIT_BLAME_USE_MAILMAP |
-                        # -w, requires https://github.com/libgit2/libgit2/commit/9830ab3d
-                        pygit2.GIT_BLAME_IGNORE_WHITESPACE |
-                        # -M, not implemented as at libgit2 v1.1.0
-                        pygit2.GIT_BLAME_TRACK_COPIES_SAME_FILE |  # -M
-                        # -C, not implemented as at libgit2 v1.1.0
-                        pygit2.GIT_BLAME_TRACK_COPIES_SAME_COMMIT_MOVES  # -C
-                    ))
-                authors, dates = collections.Counter(), collections.Counter()
-                for hunk in blame:
-                    # Constantly re-looking up the commit is probably very inefficient.
-                    # Therefore we explicitly memoize it.
-                    signature = hunk2signature(repo, hunk)
-                    author = signature.name
-                    authors[author] += hunk.lines_in_hunk
-                    # NOTE: signature.time is unix epoch (integer, not float)
-                    # We use a date ordinal so we can take the mean easily, because
-                    # datetime.date objects can't be sum()med.
-                    logging.debug('time is %s', signature.time)
-                    dates[epoch_to_date_ordinal(signature.time)] += hunk.lines_in_hunk
-                if sum(dates.values()) == 0:
-                    logging.info('ignoring empty file %s', entry_path)
-                    continue
-                author_mode = authors.most_common(1)[0][0]
-                date_mode = datetime.date.fromordinal(dates.most_common(1)[0][0])
-                date_mean = datetime.date.fromordinal(int(statistics.mean(dates.elements())))
-                # FIXME: collate mean(time) and mode(time), print nicer line.
-                writer.writerow((
-                    date_mean,
-                    date_mode,
-                    author_mode,
-                    entry_path))
-
+                yield entry_path
         else:
             raise Exception('Unknown TreeEntry type', entry, entry.type)
 
 
-@functools.lru_cache()          # <twb> Wooo, speedup from 3.244s to 3.184s!
-def hunk2signature(repo, hunk):
-    return repo.revparse_single(str(hunk.orig_commit_id)).author
-
-
-# This is like //86400, but slower and (theoretically) less buggy.
-def epoch_to_date_ordinal(i: int) -> int:
-    return datetime.datetime.utcfromtimestamp(i).toordinal()
+def blame(repo, commit, entry_path):
+    hunks = repo.blame(
+        entry_path,
+        newest_commit=commit.id,
+        flags=(
+            # Ref. https://github.com/libgit2/libgit2/blob/HEAD/include/git2/blame.h#L31
+            # requires https://github.com/libgit2/libgit2/commit/e3dcaca5
+            # FIXME: mailmap still ignored as at these Debian 11 in 2021:
+            #     libgit2-1.1=1.1.0+dfsg.1-4
+            #     python3-pygit2=1.4.0+dfsg1-1
+            pygit2.GIT_BLAME_USE_MAILMAP |
+            # -w, requires https://github.com/libgit2/libgit2/commit/9830ab3d
+            pygit2.GIT_BLAME_IGNORE_WHITESPACE |
+            # -M, not implemented as at libgit2 v1.1.0
+            pygit2.GIT_BLAME_TRACK_COPIES_SAME_FILE |  # -M
+            # -C, not implemented as at libgit2 v1.1.0
+            pygit2.GIT_BLAME_TRACK_COPIES_SAME_COMMIT_MOVES  # -C
+        ))
+    authors, dates = collections.Counter(), collections.Counter()
+    for hunk in hunks:
+        # Constantly re-looking up the commit is probably very inefficient.
+        # Therefore we explicitly memoize it (by commit, not by hunk).
+        signature = commit_author(repo, hunk.orig_commit_id)
+        author = signature.name
+        authors[author] += hunk.lines_in_hunk
+        # NOTE: signature.time is unix epoch (integer, not float)
+        # We use a date ordinal so we can take the mean easily, because
+        # datetime.date objects can't be sum()med.
+        logging.debug('time is %s', signature.time)
+        # NOTE: UTC days since the epoch, same as utcfromtimestamp(i).toordinal().
+        dates[signature.time // 86400 + EPOCH_ORDINAL] += hunk.lines_in_hunk
+    if sum(dates.values()) == 0:
+        logging.info('ignoring empty file %s', entry_path)
+        return None
+    author_mode = max(authors.items(), key=operator.itemgetter(1))[0]
+    date_mode = datetime.date.fromordinal(max(dates.items(), key=operator.itemgetter(1))[0])
+    # Weighted mean straight off the histogram, instead of expanding it
+    # one element per line with dates.elements().
+    date_mean = datetime.date.fromordinal(
+        sum(date * count for date, count in dates.items()) // sum(dates.values()))
+    # FIXME: collate mean(time) and mode(time), print nicer line.
+    return (
+        date_mean,
+        date_mode,
+        author_mode,
+        entry_path)
+
+
+# NOTE: this used to be an lru_cache keyed on the hunk, which is a new object every time,
+#       so it never hit.  Oid objects hash by value, so key on that.
+#       A plain dict keyed on just the Oid also skips building and hashing
+#       a (repo, oid) key tuple every call.
+commit_authors = {}
+
+
+def commit_author(repo, oid):
+    signature = commit_authors.get(oid)
+    if signature is None:
+        signature = commit_authors[oid] = repo[oid].author
+    return signature
 
 
 if __name__ == '__main__':
@@ -1,12 +1,22 @@
 #!/usr/bin/python3
 
+import argparse
 import collections
+import concurrent.futures
 import csv
 import datetime
+import functools
+import operator
+import os
+import queue
+import re
 import subprocess
 import sys
 
-import magic
+try:
+    import magic                # optional, only needed for --libmagic
+except ImportError:
+    magic = None
 
 __DOC__ = """ identify "stale" parts of a codebase
 
@@ -21,13 +31,19 @@ FIXME: citation needed.
 Overview:
  1. list all regular files in commit (e.g. HEAD).
  2. skip any binary files (e.g. foo.jpg, bar.zip).
- 3. for anything that's left, use "git blame -w -M -C" to find the age of each line.
+    (--libmagic asks libmagic1 instead of just looking for NULs & control characters.)
+ 3. for anything that's left, use "git blame" to find the age of each line.
+    (--accurate adds "-w -M", and --detect-copies adds "-C", which are slower.)
  4. report the mean & modal age for that file.
 
 EXAMPLE USAGE:
   sunset-blame.py
   sunset-blame.py origin/stable
   sunset-blame.py origin/stable src/ doc/
+  sunset-blame.py --accurate origin/stable src/
+  sunset-blame.py --accurate --detect-copies origin/stable src/
+  sunset-blame.py --fast
+  sunset-blame.py --stale-before 2020-01-01
 
 EXAMPLE OUTPUT:
   $ sunset-blame.py | column -t
@@ -37,87 +53,393 @@ EXAMPLE OUTPUT:
 """
 
 
-ls_tree_args = sys.argv[1:] or ['HEAD']
-commit = ls_tree_args[0]
+# Files that are obviously binary, going by the name alone.
+BINARY_SUFFIXES = frozenset({
+    '.jpg', '.jpeg', '.png', '.gif', '.webp', '.ico',
+    '.zip', '.gz', '.xz', '.bz2', '.tar', '.7z', '.jar',
+    '.pdf', '.mp3', '.mp4', '.mov', '.ogg',
+    '.woff', '.woff2', '.ttf', '.otf', '.eot',
+    '.so', '.a', '.o', '.dll', '.dylib', '.exe', '.wasm',
+    '.pyc', '.class'})
 
-paths = [
-    path
-    for line in subprocess.check_output(
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__DOC__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('commit', nargs='?', default='HEAD')
+    parser.add_argument('paths', nargs='*', metavar='path')
+    parser.add_argument(
+        '--accurate', action='store_true',
+        help='use "git blame -w -M", i.e. ignore whitespace changes,'
+        ' and follow lines moved within a file.'
+        ' This is slower, and'
+        ' usually makes little difference to how stale a file looks.')
+    parser.add_argument(
+        '--detect-copies', action='store_true',
+        help='also use "git blame -C", i.e. follow lines moved or copied between files.'
+        ' This is MUCH slower (especially on big, old repos with lots of refactoring).')
+    parser.add_argument(
+        '--fast', action='store_true',
+        help='don\'t blame anything; instead report when (and by whom)'
+        ' each file was LAST TOUCHED, from a single "git log".'
+        ' Both DATE columns are then the commit date of the newest commit to touch it'
+        ' (i.e. when it landed, even if it was authored long before and rebased/cherry-picked).'
+        ' This is MUCH faster, but one typo fix makes a whole file look fresh.')
+    parser.add_argument(
+        '--stale-before', type=datetime.date.fromisoformat, metavar='YYYY-MM-DD',
+        help='like --fast, but only for files nobody has touched since this date'
+        ' (they\'re stale however you count it); still blame everything else.')
+    parser.add_argument(
+        '--libmagic', action='store_true',
+        help='only blame files libmagic1 (python3-magic) says are text/*,'
+        ' instead of anything without NULs or lots of control characters.'
+        ' This is slower, and also skips e.g. JSON and SVG (application/json, image/svg+xml).')
+    args = parser.parse_args()
+    if args.libmagic and magic is None:
+        parser.error('--libmagic needs python3-magic')
+    ls_tree_args = [args.commit, *args.paths]
+    commit = args.commit
+    # NOTE: -C is by far the most expensive, because it has to look at other files too.
+    blame_options = (
+        (['-w', '-M'] if args.accurate else []) +
+        (['-C'] if args.detect_copies else []))
+
+    # Stream the tree as git ls-tree walks it, instead of waiting for all of it,
+    # so the first files get blamed while git is still listing the rest.
+    blobs = ls_tree(ls_tree_args)
+    if args.fast or args.stale_before:
+        # ...except --fast has to know every path up front, see last_touched().
+        blobs = list(blobs)
+
+    # Rows are written by the parent only, and there are a lot of them,
+    # so write them to stdout in 1MiB chunks, not the default 8KiB (or a line at a time on a tty).
+    with open(sys.stdout.fileno(), 'w',
+              buffering=1 << 20,
+              encoding=sys.stdout.encoding,
+              errors=sys.stdout.errors,
+              newline='',
+              closefd=False) as stdout:
+        # Write header line.
+        writer = csv.writer(stdout)
+        writer.writerow(('DATE(MODE)', 'DATE(MEAN)', 'AUTHOR', 'PATH'))
+
+        file_last_touched = (
+            last_touched(commit, args.paths, {path for _, path in blobs})
+            if args.fast or args.stale_before else None)
+        if args.fast:
+            file_last_touched = {
+                path: (commit_time, author)
+                for path, (commit_time, author_time, author) in file_last_touched.items()}
+        elif args.stale_before:
+            # Only skip blaming the files that already look stale, i.e.
+            # not touched since (local) midnight at the start of that day.
+            # Test the newest commit's COMMIT time: nothing in the file's history
+            # can be newer than that, whereas its author time can be (rebase, cherry-pick).
+            # Report its author time, though, same as git blame would for a one-commit file.
+            cutoff = datetime.datetime.combine(args.stale_before, datetime.time()).timestamp()
+            file_last_touched = {
+                path: (author_time, author)
+                for path, (commit_time, author_time, author) in file_last_touched.items()
+                if commit_time < cutoff}
+
+        # Stage 1: find the text files.
+        # This needs only one "git cat-file --batch" (and libmagic1 handle),
+        # both used from the main thread only (neither is thread-safe).
+
+        if args.libmagic:
+            # Setup libmagic1.
+            mime_database = magic.open(magic.MAGIC_MIME_TYPE)
+            _ = mime_database.load()
+            if _ != 0:
+                raise RuntimeError('Failed to initialize libmagic1 database', _)
+            is_text = functools.partial(libmagic_is_text, mime_database)
+        else:
+            is_text = looks_text
+
+        # Setup one long-running "git cat-file --batch" for the whole run.
+        # Forking a fresh "git show" for every file took around 1s for every 100 files.
+        # Ref. git-cat-file(1), section "BATCH OUTPUT".
+        # NOTE: if cat-file dies, the next readline() is empty, and cat_file_head raises.
+        cat_file = subprocess.Popen(
+            ['git', 'cat-file', '--batch'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+        # Stage 2: blame the text files (and nothing else),
+        # which is where nearly all the time goes.
+        # Each file is independent, so farm them out to one worker thread per CPU.
+        # Threads are enough, because the heavy lifting happens in git, not Python.
+        # (More threads than CPUs doesn't help: git blame itself is CPU-bound.)
+        # executor.map() submits everything up front, so stage 1 runs in the main thread
+        # while the workers are already blaming.
+        # Only the main thread writes to stdout, and executor.map() keeps ls-tree order.
+        cpus = usable_cpus()
+        cpu_queue = queue.SimpleQueue()
+        for cpu in cpus:
+            cpu_queue.put(cpu)
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=len(cpus),
+                initializer=pin_to_cpu,
+                initargs=(cpu_queue,)) as executor:
+            # filter(None, ...) drops empty files, which blame_path() returns as None.
+            writer.writerows(filter(None, executor.map(
+                functools.partial(blame_path, commit, blame_options, file_last_touched),
+                text_paths(blobs, is_text, cat_file))))
+
+    cat_file.stdin.close()
+    if cat_file.wait() != 0:
+        raise subprocess.CalledProcessError(cat_file.returncode, cat_file.args)
+
+
+def ls_tree(ls_tree_args: list):
+    # Yield (blob id, path) for each file.
+    # Keep the blob id git ls-tree already gave us,
+    # so git cat-file doesn't have to look up "<commit>:<path>" in the tree again.
+    # With -z, each entry is "<mode> <type> <object>\t<path>\0".
+    with subprocess.Popen(
             ['git', 'ls-tree', '-z', '-r', *ls_tree_args],
-            text=True).strip('\x00').split('\x00')
-    for metadata, path in [line.split('\t', 1)]
-    # Skip submodules as they don't Just Work, e.g.
-    #
-    #     bash5$ git -C coreutils.git ls-tree -r v9.1 gnulib
-    #     160000 commit 58c597d13bc57dce3e97ea97856573f2d68ccb8c	gnulib
-    #     bash5$ git -C coreutils.git show v9.1:gnulib
-    #     fatal: bad object v9.1:gnulib
-    if ' commit ' not in metadata]
+            stdout=subprocess.PIPE,
+            text=True) as p:
+        tail = ''
+        while chunk := p.stdout.read(65536):
+            *entries, tail = (tail + chunk).split('\x00')
+            for entry in entries:
+                metadata, path = entry.split('\t', 1)
+                # Skip submodules as they don't Just Work, e.g.
+                #
+                #     bash5$ git -C coreutils.git ls-tree -r v9.1 gnulib
+                #     160000 commit 58c597d13bc57dce3e97ea97856573f2d68ccb8c	gnulib
+                #     bash5$ git -C coreutils.git show v9.1:gnulib
+                #     fatal: bad object v9.1:gnulib
+                if ' commit ' in metadata:
+                    continue
+                # Don't even bother asking git cat-file about foo.jpg or bar.zip.
+                if os.path.splitext(path)[1].lower() in BINARY_SUFFIXES:
+                    continue
+                yield metadata.split()[2], path
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, p.args)
+
+
+def last_touched(commit: str, paths: list, wanted: set) -> dict:
+    # Map each wanted path to (commit time, author time, author) of the newest commit that touched it,
+    # using ONE "git log" for the whole tree, instead of "git log -1" per file.
+    # NOTE: "newest" is by commit time (that's git log's order);
+    #       a rebased/cherry-picked commit can have a much older author time (what git blame shows).
+    # With -z, each commit is "\x01<commit time> <author time> <email>\0",
+    # then "\n<path>\0<path>\0..." (nothing for merges).
+    # Stream it, and stop as soon as every wanted path has turned up,
+    # instead of reading (and holding) the entire history.
+    result = {}
+    with subprocess.Popen(
+            # --relative, so paths are relative to the current directory, same as git ls-tree's
+            # (not the top of the repo), when we're run from a subdirectory.
+            ['git', 'log', '-z', '--name-only', '--relative', '--format=%x01%ct %at %aE',
+             commit, '--', *paths],
+            stdout=subprocess.PIPE,
+            text=True) as p:
+        tail = ''
+        while len(result) < len(wanted) and (chunk := p.stdout.read(65536)):
+            *tokens, tail = (tail + chunk).split('\x00')
+            for token in tokens:
+                if token.startswith('\x01'):
+                    commit_time, author_time, email = token[1:].split(' ', 2)
+                    # Get the "twb" part of "twb@example.net"
+                    commit_info = (int(commit_time), int(author_time), email.split('@')[0])
+                elif token:
+                    path = token[1:] if token.startswith('\n') else token
+                    if path in wanted:
+                        result.setdefault(path, commit_info)
+        if len(result) < len(wanted):
+            # We read it all, so git log had better have finished happily.
+            if p.wait() != 0:
+                raise subprocess.CalledProcessError(p.returncode, p.args)
+        else:
+            # We're done early, so stop git log walking the rest of history.
+            p.terminate()
+    return result
+
+
+def usable_cpus() -> list:
+    # NOTE: os.cpu_count() also counts CPUs we aren't allowed to run on
+    #       (taskset, or a cgroup cpuset in a container/CI runner),
+    #       so a pool that size oversubscribes the ones we do have.
+    try:
+        return sorted(os.sched_getaffinity(0))
+    except AttributeError:      # not Linux
+        return list(range(os.cpu_count()))
+
+
+def pin_to_cpu(cpu_queue) -> None:
+    # Pin each worker thread (and so the git processes it starts) to its own CPU,
+    # so they don't keep migrating between cores and thrashing each other's caches.
+    # Put the CPU back at the end of the queue, so it's round-robin
+    # (rather than hanging) if the pool ever starts more workers than there are CPUs.
+    cpu = cpu_queue.get()
+    cpu_queue.put(cpu)
+    if hasattr(os, 'sched_setaffinity'):  # not Linux
+        os.sched_setaffinity(0, {cpu})
+
 
-# FIXME: this turns into [''] not [] when you do "sunset-blame HEAD -- doesnotexist.py".
-# FIXME: this crashes when it hits a git submodule.
-#        git ls-tree says "16xxx commit" instead of "10xxx blob" there, but
-#        git ls-tree --name-only doesn't, and I don't want to parse the former.
+# libmagic (and looks_text) only look at the start of the file, so that's all we keep.
+MIME_SNIFF_SIZE = 4096
 
 
+def cat_file_head(cat_file, object_name: str) -> bytes:
+    cat_file.stdin.write(object_name.encode() + b'\n')
+    cat_file.stdin.flush()
+    # "<sha> blob <size>\n", or "<object> missing\n" if it doesn't exist.
+    header = cat_file.stdout.readline().split()
+    if len(header) != 3:
+        raise RuntimeError('git cat-file failed', object_name, header)
+    object_size = int(header[2])
+    data = cat_file.stdout.read(min(object_size, MIME_SNIFF_SIZE))
+    # Skip the rest of the blob (and the trailing LF), so the next read starts at the next header.
+    # Do it 64KiB at a time, so a 50MB vendored blob doesn't briefly cost us 50MB of RAM.
+    remaining = object_size - len(data) + 1
+    while remaining:
+        chunk = cat_file.stdout.read(min(remaining, 1 << 16))
+        if not chunk:
+            raise RuntimeError('git cat-file died', object_name)
+        remaining -= len(chunk)
+    return data
 
-# Setup libmagic1.
-mime_database = magic.open(magic.MAGIC_MIME_TYPE)
-_ = mime_database.load()
-if _ != 0:
-    raise RuntimeError('Failed to initialize libmagic1 database', _)
 
-# Write header line.
-writer = csv.writer(sys.stdout)
-writer.writerow(('DATE(MODE)', 'DATE(MEAN)', 'AUTHOR', 'PATH'))
+# Magic numbers of common binary formats, which we spot without asking libmagic1 (or looks_text).
+BINARY_MAGIC = (
+    b'\x1f\x8b',                   # gzip
+    b'BZh',                        # bzip2
+    b'\xfd7zXZ\x00',               # xz
+    b'7z\xbc\xaf',                  # 7-zip
+    b'PK\x03\x04',                  # zip, jar, docx, ...
+    b'\x89PNG', b'\xff\xd8\xff', b'GIF8',
+    b'%PDF-',
+    b'\x7fELF', b'\xca\xfe\xba\xbe', b'\x00asm')
 
-for path in paths:
 
+# C0 control characters that don't turn up in ordinary text.
+# (i.e. all of them except \b \t \n \v \f \r and ESC.)
+CONTROL_BYTES = bytes(sorted(set(range(32)) - set(b'\b\t\n\v\f\r\x1b')))
+
+
+def looks_text(data: bytes) -> bool:
+    # Roughly what grep(1) and diff(1) do: text has no NULs,
+    # and hardly any other control characters.
+    # bytes.translate() does the counting in C, so this is ~memchr speed,
+    # compared to libmagic1 walking its whole (~10MB) rule database every time.
+    # NOTE: unlike libmagic1, this calls UTF-16 binary, and JSON/SVG/etc. text.
+    return (
+        b'\x00' not in data and
+        len(data) - len(data.translate(None, CONTROL_BYTES)) <= len(data) // 8)
+
+
+def libmagic_is_text(mime_database, data: bytes) -> bool:
     ## Ref. https://docs.python.org/3/library/subprocess.html#replacing-shell-pipeline
-    ## FIXME: non-zero exit of git (pipe source) is ignored!
     ## FIXME: can I use libmagic1 directly from python, instead of forking out to file(1) ?
     ## ANSWER: yes: it's "apt-get install python3-magic".
-    ##source = subprocess.Popen(['git', 'show', '{}:{}'.format()], stdout=subprocess.PIPE)
-    ##data = subprocess.check_output(['file', '--mime', '-'], stdin=source.stdout).decode()
-    ##
-    ## FIXME: we only need to read the first 4KiB from git show,
-    ## but we want to check its exit code, too!
-    ## check_output is safer.
     ##
-    ## NOTE: This takes around 1s for every 100 files.
-    data = subprocess.check_output(['git', 'show', '{}:{}'.format(commit, path)])
-    data = mime_database.buffer(data)
-
-    if data.startswith('text/'):
-        # Get the datestamp & author of each line of the file.
-
-        # FIXME: initial implementation uses --line-porcelain, which
-        # outputs one timestamp for each line in the source file.
-        # It would be MUCH MUCH faster to use --porcelain,
-        # then parse out the timestamp & the number of affected lines.
-        #
-        # FIXME: would regexps be faster?
-        # FIXME: we explicitly **DO NOT** call decode() on this output,
-        # because it is a mix of different encodings (depending on the input data).
-        data = subprocess.check_output(['git', 'blame', '--line-porcelain', '-wMC', commit, '--', path])
-        dates = [int(line.split()[1])
-                 for line in data.split(b'\n')
-                 if line.startswith(b'author-time ')]
-        timestamp_mode = collections.Counter(dates).most_common(1)[0][0]
-        timestamp_mean = sum(dates) / len(dates)
-
-        # Get the "twb" part of "<twb@example.net>"
-        authors = [line.decode().split()[1].split('<')[1].split('@')[0]
-                   for line in data.split(b'\n')
-                   if line.startswith(b'author-mail ')]
-        author_mode = collections.Counter(authors).most_common(1)[0][0]
-
-        writer.writerow((
-            datetime.date.fromtimestamp(timestamp_mode),
-            datetime.date.fromtimestamp(timestamp_mean),
-            author_mode,
-            path))
+    return mime_database.buffer(data).startswith('text/')
+
+
+def text_paths(blobs, is_text, cat_file):
+    # Identical files (vendored copies, generated files, ...) share a blob id,
+    # so only ask cat-file (& libmagic1) about each blob once.
+    blob_is_text = {}
+    for object_id, path in blobs:
+        if object_id not in blob_is_text:
+            data = cat_file_head(cat_file, object_id)
+            blob_is_text[object_id] = (
+                # Empty files have nothing to blame.
+                bool(data) and
+                not data.startswith(BINARY_MAGIC) and
+                is_text(data))
+        if blob_is_text[object_id]:
+            yield path
+
+
+# The only lines of git blame --incremental we care about (after each hunk's first line).
+# One C-level match per line, instead of up to three startswith() calls;
+# m.lastindex says which one it was:
+#   1: author-time, i.e. unix epoch
+#   2: author-mail, i.e. the "twb" part of "<twb@example.net>"
+#   None: filename, i.e. end of the hunk
+BLAME_LINE = re.compile(rb'author-time (\d+)|author-mail <([^@>\n]*)|filename ')
+
+
+def blame_path(commit: str, blame_options: list, file_last_touched: dict, path: str):
+
+    # --fast (or --stale-before and this file is old enough): skip git blame entirely.
+    # A file only changed by a merge isn't in "git log --name-only", so blame that one after all.
+    if file_last_touched is not None and path in file_last_touched:
+        timestamp, author = file_last_touched[path]
+        return (
+            datetime.date.fromtimestamp(timestamp),
+            datetime.date.fromtimestamp(timestamp),
+            author,
+            path)
+
+    # Get the datestamp & author of each hunk of the file.
+    #
+    # --incremental prints a "<sha> <orig-line> <final-line> <lines-in-hunk>" line,
+    # some "key value" lines, then a "filename" line for each hunk.
+    # The author-* lines only appear the first time a commit shows up,
+    # so remember them per commit.
+    # This is MUCH MUCH faster than --line-porcelain, which repeats them for every line.
+    # Ref. git-blame(1), section "THE PORCELAIN FORMAT".
+    #
+    # FIXME: we explicitly **DO NOT** call decode() on this output,
+    # because it is a mix of different encodings (depending on the input data).
+    dates, authors = collections.Counter(), collections.Counter()
+    # Keep a running (weighted) total for the mean, so we needn't walk the Counter again.
+    date_sum = line_count = 0
+    commits = {}
+    record = None
+    with subprocess.Popen(
+            ['git', 'blame', '--incremental', *blame_options, commit, '--', path],
+            stdout=subprocess.PIPE) as p:
+        for line in p.stdout:
+            if record is None:
+                sha, _, _, lines_in_hunk = line.split()
+                record = commits.setdefault(sha, {})
+                continue
+            m = BLAME_LINE.match(line)
+            if m is None:
+                continue        # summary, committer-*, previous, etc.
+            elif m.lastindex == 1:
+                record['time'] = int(m[1])
+            elif m.lastindex == 2:
+                # Keep it as bytes, instead of decode()+split() making 4+ strings per line;
+                # only the winning author gets decoded, at the end.
+                record['author'] = m[2]
+            else:
+                # End of record, add it to the counters.
+                lines_in_hunk = int(lines_in_hunk)
+                dates[record['time']] += lines_in_hunk
+                authors[record['author']] += lines_in_hunk
+                date_sum += record['time'] * lines_in_hunk
+                line_count += lines_in_hunk
+                record = None
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, p.args)
+    if not line_count:
+        return None
+
+    # NOTE: same answer as most_common(1)[0][0] (ties go to whichever came first),
+    #       without going via heapq.nlargest().
+    timestamp_mode = max(dates.items(), key=operator.itemgetter(1))[0]
+    timestamp_mean = date_sum / line_count
+    author_mode = max(authors.items(), key=operator.itemgetter(1))[0].decode('utf8', 'replace')
+
+    return (
+        datetime.date.fromtimestamp(timestamp_mode),
+        datetime.date.fromtimestamp(timestamp_mean),
+        author_mode,
+        path)
+
 
+if __name__ == '__main__':
+    main()
 
 
 # 13:07 <twb> What's the best way to get the mode (most common value) from a list of integers?